@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import atexit
+import copy
 from enum import Enum
 from networkstatus import TestObserver
 import logging
@@ -19,6 +21,14 @@ class Hardware(TestObserver):
         EXTENDED_FAIL = 25
         TEST_RUNNING = 12
 
+    LED_PINS = [led.value for led in Leds]
+
+    # Durations in nanoseconds, the unit of time.monotonic_ns()
+    SECOND = 1000 * 1000 * 1000
+    HOUR = 60 * 60 * SECOND
+    DAY = 24 * HOUR
+    WEEK = 7 * DAY
+
     class Buttons(Enum):
         RUN_TEST = 16
 
@@ -26,6 +36,7 @@ class Hardware(TestObserver):
         NO_INPUT = 0
         NORMAL_TEST = 1
         EXTENDED_TEST = 2
+        STOP = 3
 
     class TestState:
         def __init__(self):
@@ -33,154 +44,228 @@ class Hardware(TestObserver):
             self.extended_test_result = True
             self.scheduled_normal_test = True
             self.scheduled_extended_test = True
-            self.last_normal_test_failure_time = 0
-            self.last_extended_test_failure_time = 0
+            # Times are from time.monotonic_ns(), which counts up from boot on Linux. "Never" is a negative time far enough
+            # back to be older than the longest duration it is compared against, so the times stay integers.
+            self.last_normal_test_failure_time = -Hardware.WEEK - 1
+            self.last_extended_test_failure_time = -Hardware.WEEK - 1
             self.normal_test_running = False
             self.extended_test_running = False
-            self.last_normal_test_started_time = 0
-            self.last_extended_test_started_time = 0
+            self.last_normal_test_started_time = -Hardware.SECOND - 1
+            self.last_extended_test_started_time = -Hardware.SECOND - 1
 
     def __init__(self):
         self.test_state_lock = threading.Lock()
         self.test_state = self.TestState()
+        # Set whenever test_state is modified so the LED writer only copies the state when it has changed
+        self.test_state_changed = True
+        self.test_state_snapshot = None
 
-        self.led_lock = threading.Lock()
+        # Only the LED writer thread writes to the LEDs, so the LED state does not need a lock
+        self.led_values = None
+        self.led_update_requested = threading.Event()
+        self.led_writer_stopped = threading.Event()
+        # Set from a signal handler, so this is a plain flag rather than an Event (which takes a lock)
+        self.stop_requested = False
         GPIO.setwarnings(False)
         # Blink all LEDs for 1 second
         GPIO.setmode(GPIO.BCM)
         for button in self.Buttons:
-            GPIO.setup(button.value, GPIO.IN)
-        for led in self.Leds:
-            GPIO.setup(led.value, GPIO.OUT)
-            GPIO.output(led.value, False)
+            GPIO.setup(button.value, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+        GPIO.setup(self.LED_PINS, GPIO.OUT, initial=GPIO.LOW)
         time.sleep(1)
-        for led in self.Leds:
-            GPIO.output(led.value, True)
+        GPIO.output(self.LED_PINS, GPIO.HIGH)
         time.sleep(1)
-        for led in self.Leds:
-            GPIO.output(led.value, False)
+        GPIO.output(self.LED_PINS, GPIO.LOW)
+        self.led_writer_thread = threading.Thread(target=self.__led_writer, daemon=True)
+        self.led_writer_thread.start()
+        atexit.register(self.__shutdown)
+
+    def __shutdown(self):
+        """
+        Turn off the LEDs and release the GPIO pins when the interpreter exits.
+        """
+        # Stop the LED writer first so that it cannot turn an LED back on
+        self.led_writer_stopped.set()
+        self.led_update_requested.set()
+        self.led_writer_thread.join()
+        try:
+            GPIO.output(self.LED_PINS, GPIO.LOW)
+        finally:
+            GPIO.cleanup()
 
-    def __del__(self):
-        for led in self.Leds:
-            GPIO.output(led.value, False)
+    def request_stop(self):
+        """
+        Make get_user_input return STOP, interrupting a wait for the button. Safe to call from a signal handler.
+        """
+        self.stop_requested = True
+
+    def is_stop_requested(self):
+        """
+        Check whether a stop was requested.
+
+        Python only runs signal handlers between bytecode instructions, so a signal that interrupted a wait may not
+        have been handled yet when the wait raises. Calling a function lets any pending handlers run first.
+        """
+        return self.stop_requested
 
     def notify_test_started(self, test_type):
         """
         Update the LEDs to indicate a test is running.
         """
-        self.test_state_lock.acquire()
-        try:
+        current_time = time.monotonic_ns()
+        with self.test_state_lock:
             if test_type == TestObserver.TestType.NORMAL:
                 self.test_state.normal_test_running = True
-                self.test_state.last_normal_test_started_time = time.time()
-            if test_type == TestObserver.TestType.EXTENDED:
+                self.test_state.last_normal_test_started_time = current_time
+            elif test_type == TestObserver.TestType.EXTENDED:
                 self.test_state.extended_test_running = True
-                self.test_state.last_extended_test_started_time = time.time()
-        finally:
-            self.test_state_lock.release()
+                self.test_state.last_extended_test_started_time = current_time
+            self.test_state_changed = True
         self.__update_leds()
 
     def notify_test_completed(self, test_type, result):
-        self.test_state_lock.acquire()
-        try:
+        current_time = time.monotonic_ns()
+        with self.test_state_lock:
             if test_type == TestObserver.TestType.NORMAL:
                 self.test_state.normal_test_result = result
                 self.test_state.normal_test_running = False
                 self.test_state.scheduled_normal_test = False
                 if not result:
-                    self.test_state.last_normal_test_failure_time = time.time()
+                    self.test_state.last_normal_test_failure_time = current_time
             elif test_type == TestObserver.TestType.EXTENDED:
                 self.test_state.extended_test_result = result
                 self.test_state.extended_test_running = False
                 self.test_state.scheduled_extended_test = False
                 if not result:
-                    self.test_state.last_extended_test_failure_time = time.time()
-        finally:
-            self.test_state_lock.release()
+                    self.test_state.last_extended_test_failure_time = current_time
+            self.test_state_changed = True
         self.__update_leds()
 
     @staticmethod
-    def __get_blink_state(last_failure_time):
-        current_time = time.time()
-        hour = 60 * 60
-        day = 24 * hour
-        week = 7 * day
-        if last_failure_time + hour >= current_time:
-            return round(current_time * 10) % 2 > 0  # Quick blinking
-        elif last_failure_time + day >= current_time:
-            return round(current_time) % 2 > 0  # Slow blinking with long pause
-        elif last_failure_time + week >= current_time:
-            return round(current_time * 10) % 20 > 0  # Slow blinking with short pause
-        else:
-            return True
-
-    def update(self):
-        self.__update_leds()
+    def __get_blink_states(last_failure_times, current_time):
+        """
+        Get the blink state of the pass LEDs.
+
+        :param last_failure_times: The last failure time of each LED
+        :param current_time: The current time from time.monotonic_ns()
+        :return: A tuple with whether each LED is currently on
+        """
+        tick = current_time // (Hardware.SECOND // 10)  # 10 ticks per second
+        # Indexed by how long ago the last failure was: within an hour, a day, a week, or longer
+        blink_patterns = (
+            tick & 1 > 0,  # Quick blinking
+            (tick // 10) & 1 > 0,  # Slow blinking with long pause
+            tick % 20 > 0,  # Slow blinking with short pause
+            True
+        )
+        blink_states = []
+        for last_failure_time in last_failure_times:
+            age = current_time - last_failure_time
+            blink_states.append(blink_patterns[(age > Hardware.HOUR) + (age > Hardware.DAY) + (age > Hardware.WEEK)])
+        return tuple(blink_states)
 
     def __update_leds(self):
-        current_time = time.time()
-        min_test_running_led_time = 1
-        self.test_state_lock.acquire()
-        try:
-            test_state = self.test_state
-        finally:
-            self.test_state_lock.release()
-        normal_blink_state = Hardware.__get_blink_state(test_state.last_normal_test_failure_time)
-        extended_blink_state = Hardware.__get_blink_state(test_state.last_extended_test_failure_time)
-        self.led_lock.acquire()
+        """
+        Request the LED writer thread to update the LEDs. Requests made while one is already pending are coalesced.
+        """
+        self.led_update_requested.set()
+
+    def __led_writer(self):
+        # The LEDs are also refreshed periodically to animate the blinking
+        update_interval = 0.1
+        while not self.led_writer_stopped.is_set():
+            self.led_update_requested.wait(timeout=update_interval)
+            self.led_update_requested.clear()
+            self.__write_leds()
+
+    def __write_leds(self):
+        current_time = time.monotonic_ns()
+        min_test_running_led_time = Hardware.SECOND
+        if self.test_state_changed:
+            with self.test_state_lock:
+                # Copy the state so that the LEDs are computed from a consistent view without holding the lock
+                self.test_state_snapshot = copy.copy(self.test_state)
+                self.test_state_changed = False
+        test_state = self.test_state_snapshot
+        normal_blink_state, extended_blink_state = Hardware.__get_blink_states(
+            (test_state.last_normal_test_failure_time, test_state.last_extended_test_failure_time),
+            current_time)
+        led_values = [
+            # NORMAL_PASS
+            normal_blink_state and
+            test_state.normal_test_result and
+            not test_state.scheduled_normal_test,
+            # NORMAL_FAIL
+            not test_state.normal_test_result and
+            not test_state.scheduled_normal_test,
+            # EXTENDED_PASS
+            extended_blink_state and
+            test_state.extended_test_result and
+            not test_state.scheduled_extended_test,
+            # EXTENDED_FAIL
+            not test_state.extended_test_result and
+            not test_state.scheduled_extended_test,
+            # TEST_RUNNING
+            test_state.normal_test_running or
+            test_state.extended_test_running or
+            test_state.last_normal_test_started_time + min_test_running_led_time >= current_time or
+            test_state.last_extended_test_started_time + min_test_running_led_time >= current_time
+        ]
+        led_values = [bool(value) for value in led_values]
+        # Most updates do not change any LED, so only write to the GPIO when something changed
+        if led_values != self.led_values:
+            GPIO.output(self.LED_PINS, led_values)
+            self.led_values = led_values
+
+    def __wait_for_edge(self, button, edge, timeout, **kwargs):
+        """
+        Wait for a button edge.
+
+        :return: None on timeout or when a stop was requested while waiting, otherwise the button
+        """
         try:
-            GPIO.output(self.Leds.NORMAL_PASS.value,
-                        normal_blink_state and
-                        test_state.normal_test_result and
-                        not test_state.scheduled_normal_test)
-            GPIO.output(self.Leds.NORMAL_FAIL.value,
-                        not test_state.normal_test_result and
-                        not test_state.scheduled_normal_test)
-            GPIO.output(self.Leds.EXTENDED_PASS.value,
-                        extended_blink_state and
-                        test_state.extended_test_result and
-                        not test_state.scheduled_extended_test)
-            GPIO.output(self.Leds.EXTENDED_FAIL.value,
-                        not test_state.extended_test_result and
-                        not test_state.scheduled_extended_test)
-            GPIO.output(self.Leds.TEST_RUNNING.value,
-                        test_state.normal_test_running or
-                        test_state.extended_test_running or
-                        test_state.last_normal_test_started_time + min_test_running_led_time >= current_time or
-                        test_state.last_extended_test_started_time + min_test_running_led_time >= current_time)
-        finally:
-            self.led_lock.release()
+            return GPIO.wait_for_edge(button, edge, timeout=max(1, int(timeout * 1000)), **kwargs)
+        except RuntimeError:
+            # RPi.GPIO raises when a signal interrupts the wait, which is how a stop request arrives
+            if self.is_stop_requested():
+                return None
+            raise
 
     def get_user_input(self, timeout):
-        sleep_time = 0.1
         button_push_time_for_extended_test = 3
-        timeout_time = time.time() + timeout
-        user_input_time = None
+        debounce_time = 0.05
+        button = self.Buttons.RUN_TEST.value
+        if self.is_stop_requested():
+            return self.UserInput.STOP
+        # A button pushed while the checks were running is still held, so only wait for a push when it is released
+        if (not GPIO.input(button) and
+           self.__wait_for_edge(button, GPIO.RISING, timeout, bouncetime=int(debounce_time * 1000)) is None):
+            if self.is_stop_requested():
+                return self.UserInput.STOP
+            # The button was not pushed and the timeout has happened
+            return self.UserInput.NO_INPUT
+
+        # Initial button push
+        user_input_time = time.monotonic()
+        with self.test_state_lock:
+            self.test_state.scheduled_normal_test = True
+            self.test_state_changed = True
+        self.__update_leds()
+
+        # Block until the button is released or held for the extended test time
         while True:
-            if user_input_time is None and GPIO.input(self.Buttons.RUN_TEST.value):
-                # Initial button push
-                user_input_time = time.time()
-                self.test_state_lock.acquire()
-                try:
-                    self.test_state.scheduled_normal_test = True
-                finally:
-                    self.test_state_lock.release()
-                self.__update_leds()
-            elif user_input_time is not None and not GPIO.input(self.Buttons.RUN_TEST.value):
+            # Let the contacts settle after the push or a falling edge so that bounce is not mistaken for a release
+            time.sleep(debounce_time)
+            if not GPIO.input(button):
                 # Button was pushed and released before the extended test time was reached
                 return self.UserInput.NORMAL_TEST
-            elif user_input_time is not None and time.time() >= user_input_time + button_push_time_for_extended_test:
+            remaining_time = user_input_time + button_push_time_for_extended_test - time.monotonic()
+            if remaining_time <= 0 or self.__wait_for_edge(button, GPIO.FALLING, remaining_time) is None:
+                if self.is_stop_requested():
+                    return self.UserInput.STOP
                 # Button was held for the extended test time
-                self.test_state_lock.acquire()
-                try:
+                with self.test_state_lock:
                     self.test_state.scheduled_extended_test = True
-                finally:
-                    self.test_state_lock.release()
+                    self.test_state_changed = True
                 self.__update_leds()
                 return self.UserInput.EXTENDED_TEST
-            elif user_input_time is None and time.time() >= timeout_time:
-                # The button was not pushed and the timeout has happened
-                return self.UserInput.NO_INPUT
-            else:
-                time.sleep(sleep_time)
-
@@ -4,23 +4,17 @@ import datetime
 import logging
 from hardware import Hardware
 import networkstatus
+import signal
 import time
-import threading
 
 logger = logging.getLogger(__name__)
 
 
-def update(hardware, update_interval):
-    while True:
-        hardware.update()
-        time.sleep(update_interval)
-
-
 def main():
     hardware = Hardware()
-    update_interval = 0.1
-    thread = threading.Thread(target=update, args=(hardware, update_interval), daemon=True)
-    thread.start()
+    # systemd stops the service with SIGTERM. The signal interrupts the wait for the button, so rather than exiting
+    # from the handler, stop the main loop and return normally so the hardware is cleaned up by the atexit handlers.
+    signal.signal(signal.SIGTERM, lambda signum, frame: hardware.request_stop())
     user_input_timeout = 1
     status_timeout = 10
     max_ping = 200
@@ -65,6 +59,8 @@ def main():
         elif user_input == hardware.UserInput.EXTENDED_TEST:
             last_normal_test = 0
             last_extended_test = 0
+        elif user_input == hardware.UserInput.STOP:
+            break
 
 
 if __name__ == "__main__":
@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import dns.resolver
 from enum import Enum
-import functools
-import json
 import logging
 import re
+import socket
 import speedtest
+import struct
 import subprocess
+import time
 
 
 logger = logging.getLogger(__name__)
 
+PING_TIME_REGEX = re.compile(r'time=([\d.]+) ms')
+
 
 class TestObserver:
 
@@ -36,11 +40,10 @@ def external_command(args, input_str=None, throw_of_error=True, timeout=10):
     :param timeout: The timeout in seconds
     :return: (standard out, standard error, error code)
     """
-    p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
-    (out, err) = p.communicate(input_str, timeout=timeout)
+    p = subprocess.run(args, input=input_str, capture_output=True, encoding='utf8', timeout=timeout)
     if throw_of_error and p.returncode != 0:
-        raise Exception('Command {} failed with code {}. {}'.format(args[0], p.returncode, err))
-    return out, err, p.returncode
+        raise Exception('Command {} failed with code {}. {}'.format(args[0], p.returncode, p.stderr))
+    return p.stdout, p.stderr, p.returncode
 
 
 def ping(host, timeout=10):
@@ -51,8 +54,8 @@ def ping(host, timeout=10):
     :param timeout: The timeout in seconds
     :return: The time in milliseconds
     """
-    out, _, _ = external_command(args=['ping', '-c', '1', '-w', str(timeout), host], timeout=timeout)
-    time_string = re.search('time=(.*) ms', out).group(1)
+    out, _, _ = external_command(args=['ping', '-n', '-c', '1', '-w', str(timeout), host], timeout=timeout)
+    time_string = PING_TIME_REGEX.search(out).group(1)
     time = float(time_string)
     return time
 
@@ -72,17 +75,33 @@ def dns_resolve(host, timeout=10):
 
 def default_gateway(timeout=10):
     """
-    Get the IPv4 default gateway
+    Get the IPv4 default gateway from the kernel routing table
 
-    :param timeout: The timeout in seconds
+    :param timeout: Unused, the routing table is read directly from /proc/net/route
     :return: The IPv4 address
     """
-    out, _, _ = external_command(args=['ip', '-j', '-4', 'route'], timeout=timeout)
-    for record in json.loads(out):
-        if record['dst'] == 'default':
-            return record['gateway']
-        continue
-    raise Exception('No default route')
+    rtf_up = 0x1
+    rtf_gateway = 0x2
+    gateway = None
+    gateway_metric = None
+    with open('/proc/net/route') as route_file:
+        next(route_file)  # Skip the header
+        for record in route_file:
+            record = record.split()
+            flags = int(record[3], 16)
+            metric = int(record[6])
+            # Only 0.0.0.0/0 routes that are up and go through a gateway are default routes. Checking the mask
+            # excludes split routes such as the 0.0.0.0/1 route OpenVPN adds for redirect-gateway def1.
+            if (record[1] != '00000000' or record[7] != '00000000' or
+               flags & (rtf_up | rtf_gateway) != rtf_up | rtf_gateway):
+                continue
+            if gateway_metric is None or metric < gateway_metric:
+                # The addresses are hexadecimal in host byte order
+                gateway = socket.inet_ntoa(struct.pack('=I', int(record[2], 16)))
+                gateway_metric = metric
+    if gateway is None:
+        raise Exception('No default route')
+    return gateway
 
 
 def dns_service_discovery(service_type, timeout=10):
@@ -96,17 +115,20 @@ def dns_service_discovery(service_type, timeout=10):
     out, _, _ = external_command(
         args=['avahi-browse', '-d', 'local', '-r', '-t', '-p', '-k', service_type],
         timeout=timeout)
-    list_with_duplicates = []
+    seen = set()
+    ret = []
     for record in out.splitlines():
         record = record.split(';')
         if record[0] != '=':
             continue
-        list_with_duplicates += [dict(
+        key = (record[3], record[7])
+        if key in seen:
+            continue  # Remove duplicates
+        seen.add(key)
+        ret.append(dict(
             name=record[3],
             address=record[7]
-        )]
-
-    ret = [dict(t) for t in {tuple(d.items()) for d in list_with_duplicates}]  # Remove duplicates
+        ))
     return ret
 
 
@@ -212,25 +234,43 @@ class PingPrinterCheck(PingCheckBase):
     Performs the printer status check
     """
 
-    def __init__(self, max_ping, timeout):
+    def __init__(self, max_ping, timeout, discovery_ttl=5 * 60):
         PingCheckBase.__init__(self, max_ping, timeout)
+        self.discovery_ttl = discovery_ttl
+        self.printers = None
+        self.printers_discovery_time = None
 
     def do_to_value(self, value_string):
         raise NotImplementedError
 
+    def __get_printers(self):
+        """
+        Get the printers, only running DNS-SD again when the previous discovery is older than the TTL
+
+        :return: [dict(name, address)] The printers
+        """
+        current_time = time.monotonic()
+        if self.printers is None or current_time >= self.printers_discovery_time + self.discovery_ttl:
+            self.printers = discover_printers(timeout=self.timeout)
+            self.printers_discovery_time = current_time
+        return self.printers
+
     def do_check(self):
         try:
-            printers = discover_printers(timeout=self.timeout)
+            printers = self.__get_printers()
             printer_addresses = ' '.join([p['address'] for p in printers])
             if len(printers) == 0:
                 raise Exception('No printer found.')
             if len(printers) > 1:
+                self.printers = None
                 logger.error('Multiple printers found, cannot resolve to a unique printer. '
                              'The following printers were found: {}.'.format(str(printers)))
                 return '{},{}'.format(self.NO_PING, printer_addresses)
             printer = printers[0]
             return '{},{}'.format(ping(printer['address']), printer_addresses)
         except Exception as e:
+            # Rediscover the printers on the next check in case the cached address is stale
+            self.printers = None
             logger.error("Failed to ping the printer. {}".format(e))
             return self.NO_PING + ","
 
@@ -376,6 +416,8 @@ class MultipleChecks(StatusCheck):
 
     def __init__(self, checks):
         self.checks = checks
+        # The checks are I/O bound, so running them in parallel makes the total time the time of the slowest check
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(checks)))
 
     def do_to_value(self, value_string):
         raise NotImplementedError
@@ -384,7 +426,7 @@ class MultipleChecks(StatusCheck):
         raise NotImplementedError
 
     def check(self):
-        return combine_checks([check.check() for check in self.checks])
+        return combine_checks(list(self.executor.map(lambda check: check.check(), self.checks)))
 
     def column_names(self):
         return ','.join([check.column_names() for check in self.checks])
@@ -393,12 +435,21 @@ class MultipleChecks(StatusCheck):
         return sum([check.num_columns() for check in self.checks])
 
 
-def combine_results(lhs, rhs):
-    if lhs is None:
-        return rhs
-    if rhs is None:
-        return lhs
-    return lhs and rhs
+def combine_results(results):
+    """
+    Combines the evaluation criteria of multiple checks
+
+    :param results: The evaluation criteria (True, False, or None)
+    :return: False if any result is False, True if any result is True and none are False, otherwise None
+    """
+    combined = None
+    for result in results:
+        if result is None:
+            continue
+        if not result:
+            return False
+        combined = True
+    return combined
 
 
 class NormalAndExtendedChecks:
@@ -410,22 +461,22 @@ class NormalAndExtendedChecks:
         self.normal_checks = normal_checks
         self.extended_checks = extended_checks
         self.test_observers= test_observers
+        # The columns are fixed, so the empty extended columns and the column names only need to be built once
+        self.skip_extended = ','.join([""] * extended_checks.num_columns())
+        self.all_column_names = normal_checks.column_names() + "," + extended_checks.column_names()
 
     def normal_check(self):
         """
         Run the normal checks
         :return: the result string
         """
-        skip_extended = (
-            ','.join([""] * self.extended_checks.num_columns())
-        )
         for observer in self.test_observers:
             observer.notify_test_started(TestObserver.TestType.NORMAL)
         results = self.normal_checks.check()
-        normal_tests_result = functools.reduce(combine_results, results[1], None)
+        normal_tests_result = combine_results(results[1])
         for observer in self.test_observers:
             observer.notify_test_completed(TestObserver.TestType.NORMAL, normal_tests_result)
-        return results[0] + "," + skip_extended
+        return results[0] + "," + self.skip_extended
 
     def extended_check(self):
         """
@@ -436,18 +487,16 @@ class NormalAndExtendedChecks:
         for observer in self.test_observers:
             observer.notify_test_started(TestObserver.TestType.NORMAL)
             observer.notify_test_started(TestObserver.TestType.EXTENDED)
-        normal_tests_result = functools.reduce(combine_results, normal_results[1], None)
+        normal_tests_result = combine_results(normal_results[1])
         extended_results = self.extended_checks.check()
-        extended_tests_result = functools.reduce(combine_results, extended_results[1], None)
+        extended_tests_result = combine_results(extended_results[1])
         for observer in self.test_observers:
             observer.notify_test_completed(TestObserver.TestType.NORMAL, normal_tests_result)
             observer.notify_test_completed(TestObserver.TestType.EXTENDED, extended_tests_result)
         return normal_results[0] + "," + extended_results[0]
 
     def column_names(self):
-        normal_column_names = self.normal_checks.column_names()
-        extended_column_names = self.extended_checks.column_names()
-        return normal_column_names + "," + extended_column_names
+        return self.all_column_names
 
     def num_columns(self):
         return self.normal_checks.num_columns() + self.extended_checks.num_columns()